@@ -1,14 +1,32 @@
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import ntpath
 import os
-from pathlib import Path
+import shutil
+import stat
+import subprocess
 import tarfile
-from typing import List, Tuple, Optional
+import threading
+from typing import BinaryIO, List, Tuple, Optional
+
+try:  # ISA-L accelerated DEFLATE, roughly 3x faster than zlib when installed
+    from isal import igzip as gzip_impl
+except ImportError:
+    import gzip as gzip_impl  # type: ignore[no-redef]
 
 
 logger = logging.getLogger("DANE")
 COMPRESSED_TAR_EXTENSION = ".tar.gz"
+DEFAULT_PART_SIZE = 8 * 1024 * 1024  # multipart threshold and chunk size (in bytes)
+DEFAULT_MAX_CONCURRENCY = 16  # max number of parallel requests (and S3 connections)
+TAR_BUFFER_SIZE = 8 * 1024 * 1024  # file/pipe buffer, avoids many small writes
+READ_BUFFER_SIZE = 1024 * 1024  # used for reading the files that are archived
+HAS_TAR_DATA_FILTER = hasattr(tarfile, "data_filter")
 
 
 # the file name without extension is used as an asset ID by the ASR container to save the results
@@ -27,10 +45,10 @@ def generate_asset_id_from_input_file(
 
 def is_valid_tar_path(archive_path: str) -> bool:
     logger.info(f"Validating {archive_path}")
-    if not os.path.exists(Path(archive_path).parent):
+    if not os.path.isdir(os.path.dirname(archive_path) or "."):
         logger.error(f"Parent dir does not exist: {archive_path}")
         return False
-    if archive_path[-7:] != COMPRESSED_TAR_EXTENSION:
+    if not archive_path.endswith(COMPRESSED_TAR_EXTENSION):
         logger.error(
             f"Archive file should have the correct extension: {COMPRESSED_TAR_EXTENSION}"
         )
@@ -43,10 +61,11 @@ def tar_list_of_files(archive_path: str, file_list: List[str]) -> bool:
     if not is_valid_tar_path(archive_path):
         return False
     try:
-        with tarfile.open(archive_path, "w:gz") as tar:
-            for item in file_list:
-                logger.info(os.path.basename(item))
-                tar.add(item, arcname=os.path.basename(item))
+        pigz = shutil.which("pigz")
+        if pigz:
+            _tar_with_pigz(pigz, archive_path, file_list)
+        else:
+            _tar_with_gzip(archive_path, file_list)
         logger.info(f"Succesfully created {archive_path}")
         return True
     except tarfile.TarError:
@@ -59,32 +78,137 @@ def tar_list_of_files(archive_path: str, file_list: List[str]) -> bool:
     return False
 
 
+# writes an uncompressed tar stream into pigz, which spreads DEFLATE over all cores
+def _tar_with_pigz(pigz: str, archive_path: str, file_list: List[str]) -> None:
+    logger.info(f"Compressing {archive_path} with {pigz}")
+    with open(archive_path, "wb") as archive:
+        proc = subprocess.Popen([pigz, "-c"], stdin=subprocess.PIPE, stdout=archive)
+        broken_pipe = False  # pigz stopped reading before the tar was complete
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                _add_files_to_tar(tar, file_list)
+        except BrokenPipeError:
+            broken_pipe = True
+        finally:
+            try:
+                proc.stdin.close()  # type: ignore[union-attr]
+            except BrokenPipeError:
+                broken_pipe = True
+            returncode = proc.wait()
+    if returncode != 0 or broken_pipe:
+        raise tarfile.TarError(f"pigz exited with return code {returncode}")
+
+
+# single-threaded fallback, uses ISA-L (python-isal) instead of zlib when available
+def _tar_with_gzip(archive_path: str, file_list: List[str]) -> None:
+    logger.info(f"Compressing {archive_path} with {gzip_impl.__name__}")
+    with open(archive_path, "wb", buffering=TAR_BUFFER_SIZE) as archive:
+        _write_compressed_tar(archive, file_list)
+
+
+def _write_compressed_tar(fileobj: BinaryIO, file_list: List[str]) -> None:
+    with gzip_impl.open(fileobj, "wb") as gz:
+        with tarfile.open(fileobj=gz, mode="w|") as tar:
+            _add_files_to_tar(tar, file_list)
+
+
+# regular files are added with a prepared TarInfo, skipping the stat, user/group name
+# lookups and recursion checks of tar.add; anything else (e.g. dirs) uses tar.add
+def _add_files_to_tar(tar: tarfile.TarFile, file_list: List[str]) -> None:
+    for item in file_list:
+        arcname = os.path.basename(item)
+        logger.info(arcname)
+        st = os.lstat(item)
+        if not stat.S_ISREG(st.st_mode):
+            tar.add(item, arcname=arcname)
+            continue
+        info = tarfile.TarInfo(name=arcname)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        with os.fdopen(_open_for_reading(item), "rb", READ_BUFFER_SIZE) as src:
+            tar.addfile(info, src)
+
+
+# O_NOATIME avoids an inode update per read file, but only works on files we own
+def _open_for_reading(path: str) -> int:
+    noatime = getattr(os, "O_NOATIME", 0)
+    try:
+        return os.open(path, os.O_RDONLY | noatime)
+    except PermissionError:
+        if not noatime:
+            raise
+        return os.open(path, os.O_RDONLY)
+
+
+# extraction filters only exist from Python 3.10.12/3.11.4, older versions only get
+# plain files and dirs that stay within the output_folder (like the "data" filter)
+def _extract_member(
+    tar: tarfile.TarFile, member: tarfile.TarInfo, output_folder: str
+) -> None:
+    if HAS_TAR_DATA_FILTER:
+        tar.extract(member, output_folder, filter="data")
+        return
+    root = os.path.realpath(output_folder)
+    target = os.path.realpath(os.path.join(root, member.name))
+    if os.path.commonpath([root, target]) != root:
+        raise tarfile.TarError(f"{member.name} would be extracted outside {root}")
+    if not (member.isfile() or member.isdir()):
+        raise tarfile.TarError(f"{member.name} is not a regular file or directory")
+    tar.extract(member, output_folder)
+
+
+class _TarStreamReader:
+    """Read end of the pipe the tar archive is streamed through. Once the
+    writer thread failed, reading raises its error, so boto3 aborts the
+    upload instead of storing a truncated archive.
+    """
+
+    def __init__(self, pipe_in: BinaryIO, writer_errors: List[Exception]):
+        self.pipe_in = pipe_in
+        self.writer_errors = writer_errors
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.pipe_in.read(size)
+        if self.writer_errors:
+            raise self.writer_errors[0]
+        return data
+
+
 def validate_s3_uri(s3_uri: str) -> bool:
-    if s3_uri[0:5] != "s3://":
-        logger.error(f"Invalid protocol in {s3_uri}")
-        return False
-    if len(s3_uri[5:].split("/")) < 2:
-        logger.error(f"No object_name specified {s3_uri}")
-        return False
-    return True
+    return parse_s3_uri(s3_uri) is not None
 
 
 # e.g. "s3://beng-daan-visxp/jaap-dane-test/dane-test.tar.gz"
-def parse_s3_uri(s3_uri: str) -> Tuple[str, str]:
+# returns the bucket and object_name, or None if the URI is invalid
+def parse_s3_uri(s3_uri: str) -> Optional[Tuple[str, str]]:
     logger.info(f"Parsing s3 URI {s3_uri}")
-    tmp = s3_uri[5:]
-    bucket = tmp[: tmp.find("/")]  # beng-daan-visxp
-    object_name = s3_uri[len(bucket) + 6 :]  # jaap-dane-test/dane-test.tar.gz
+    if not s3_uri.startswith("s3://"):
+        logger.error(f"Invalid protocol in {s3_uri}")
+        return None
+    # beng-daan-visxp, jaap-dane-test/dane-test.tar.gz
+    bucket, _, object_name = s3_uri[5:].partition("/")
+    if not bucket or not object_name:
+        logger.error(f"No object_name specified {s3_uri}")
+        return None
     return bucket, object_name
 
 
-def download_s3_uri(s3_uri: str, output_folder: str) -> bool:
-    if not validate_s3_uri(s3_uri):
+# S3 keys are always separated by "/", so os.path.join (OS dependent) is not used
+def _s3join(prefix: str, name: str) -> str:
+    return f"{prefix.rstrip('/')}/{name}" if prefix else name
+
+
+def download_s3_uri(s3_uri: str, output_folder: str, extract: bool = False) -> bool:
+    parsed_uri = parse_s3_uri(s3_uri)
+    if not parsed_uri:
         logger.error("Invalid S3 URI")
         return False
     s3_store = S3Store()
-    bucket, object_name = parse_s3_uri(s3_uri)
-    return s3_store.download_file(bucket, object_name, output_folder)
+    bucket, object_name = parsed_uri
+    return s3_store.download_file(bucket, object_name, output_folder, extract)
 
 
 class S3Store:
@@ -98,8 +222,30 @@ class S3Store:
 
     """
 
-    def __init__(self, s3_endpoint_url: Optional[str] = None, unit_testing=False):
-        self.client = boto3.client("s3", endpoint_url=s3_endpoint_url)
+    def __init__(
+        self,
+        s3_endpoint_url: Optional[str] = None,
+        unit_testing=False,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        part_size: int = DEFAULT_PART_SIZE,
+    ):
+        # one pooled connection per concurrent request, botocore's default is only 10
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=s3_endpoint_url,
+            config=BotoConfig(max_pool_connections=max_concurrency),
+        )
+        self.max_concurrency = max_concurrency
+        self.part_size = part_size
+        # large objects are transferred as concurrent multipart uploads/ranged GETs
+        self.transfer_config = self._transfer_config(max_concurrency)
+
+    def _transfer_config(self, max_concurrency: int) -> TransferConfig:
+        return TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=max_concurrency,
+        )
 
     def transfer_to_s3(
         self, bucket: str, path: str, file_list: List[str], tar_archive_path: str = ""
@@ -115,34 +261,112 @@ class S3Store:
 
             file_list = [tar_archive_path]  # now the file_list just has the tar
 
-        # now go ahead and upload whatever is in the file list
-        for f in file_list:
-            try:
-                self.client.upload_file(
+        # now go ahead and upload whatever is in the file list (concurrently), the
+        # connections are divided over the files so they stay within the pool size
+        workers = max(1, min(self.max_concurrency, len(file_list)))
+        transfer_config = self._transfer_config(max(1, self.max_concurrency // workers))
+        success = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    self.client.upload_file,
                     Filename=f,
                     Bucket=bucket,
-                    Key=os.path.join(
+                    Key=_s3join(
                         path,
                         generate_asset_id_from_input_file(  # file name with extension
                             f, True
                         ),
                     ),
+                    Config=transfer_config,
+                ): f
+                for f in file_list
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (S3UploadFailedError, BotoCoreError, ClientError, OSError):
+                    logger.exception(f"Failed to upload {futures[future]}")
+                    success = False
+        return success
+
+    # tars and compresses the file_list while uploading it, without writing the
+    # archive to local disk first
+    def transfer_to_s3_streaming(
+        self, bucket: str, object_name: str, file_list: List[str]
+    ) -> bool:
+        logger.info(f"Streaming {len(file_list)} files into {bucket}:{object_name}")
+        read_fd, write_fd = os.pipe()
+        writer_errors: List[Exception] = []
+
+        def write_tar():
+            try:
+                with open(write_fd, "wb", buffering=TAR_BUFFER_SIZE) as pipe_out:
+                    try:
+                        _write_compressed_tar(pipe_out, file_list)
+                    except Exception as e:
+                        # register the error before the pipe is closed (EOF for reader)
+                        writer_errors.append(e)
+            except BrokenPipeError as e:  # flushing on close, after the reader stopped
+                writer_errors.append(e)
+            if not writer_errors:
+                return
+            if isinstance(writer_errors[0], BrokenPipeError):
+                logger.warning("Upload stopped before the archive was written")
+            else:
+                logger.error("Failed to write archive", exc_info=writer_errors[0])
+
+        writer = threading.Thread(target=write_tar)
+        writer.start()
+        try:
+            with open(read_fd, "rb", buffering=TAR_BUFFER_SIZE) as pipe_in:
+                self.client.upload_fileobj(
+                    _TarStreamReader(pipe_in, writer_errors),
+                    bucket,
+                    object_name,
+                    Config=self.transfer_config,
                 )
-            except Exception:  # TODO figure out which Exception to catch specifically
-                logger.exception(f"Failed to upload {f}")
-                return False
-        return True
+            logger.info(f"Succesfully streamed archive to {bucket}:{object_name}")
+            return True
+        except Exception:
+            logger.exception(f"Failed to stream archive to {bucket}:{object_name}")
+            return False
+        finally:
+            writer.join()  # closing pipe_in unblocks a writer if the upload failed
 
-    def download_file(self, bucket: str, object_name: str, output_folder: str) -> bool:
+    # with extract=True a .tar.gz object is extracted while downloading (instead of
+    # saving the archive itself), see download_and_extract
+    def download_file(
+        self, bucket: str, object_name: str, output_folder: str, extract: bool = False
+    ) -> bool:
+        if extract and object_name.endswith(COMPRESSED_TAR_EXTENSION):
+            return self.download_and_extract(bucket, object_name, output_folder)
         logger.info(f"Downloading {bucket}:{object_name} into {output_folder}")
-        if not os.path.exists(output_folder):
-            logger.info("Output folder does not exist, creating it...")
-            os.makedirs(output_folder)
+        os.makedirs(output_folder, exist_ok=True)  # no race with concurrent downloads
         output_file = os.path.join(output_folder, os.path.basename(object_name))
         try:
-            with open(output_file, "wb") as f:
-                self.client.download_fileobj(bucket, object_name, f)
+            self.client.download_file(
+                bucket, object_name, output_file, Config=self.transfer_config
+            )
         except Exception:
             logger.exception(f"Failed to download {object_name}")
             return False
         return True
+
+    # extracts a .tar.gz object into the output_folder while it is being downloaded,
+    # without writing the archive itself to local disk
+    def download_and_extract(
+        self, bucket: str, object_name: str, output_folder: str
+    ) -> bool:
+        logger.info(f"Extracting {bucket}:{object_name} into {output_folder}")
+        os.makedirs(output_folder, exist_ok=True)
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=object_name)
+            with response["Body"] as body, gzip_impl.open(body, "rb") as gz:
+                with tarfile.open(fileobj=gz, mode="r|") as tar:
+                    for member in tar:
+                        _extract_member(tar, member, output_folder)
+        except Exception:
+            logger.exception(f"Failed to download and extract {object_name}")
+            return False
+        return True
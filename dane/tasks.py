@@ -71,6 +71,8 @@ class Task:
         else:
             self.args = kwargs
 
+        self._json_cache = None  # (serialised fields, JSON) of the last to_json()
+
     def assign(self, document_id):
         """Assign a task to a document, this will set an _id for the
         task and run it. Requires an API to be set.
@@ -235,9 +237,31 @@ class Task:
     def to_json(self, indent=None):
         """Returns this task serialised as JSON
 
+        The compact serialisation is cached for as long as the serialised
+        fields keep the same values. Tasks with `args` are never cached, as
+        the args can be changed in place.
+
         :return: JSON serialisation of the task
         :rtype: str
         """
+        fields = (
+            self.key,
+            self._id,
+            self.state,
+            self.msg,
+            self.created_at,
+            self.updated_at,
+            self.priority,
+        )
+        cache = self._json_cache
+        if (
+            indent is None
+            and cache is not None
+            and cache[0] == fields
+            and not self.args
+        ):
+            return cache[1]
+
         task_data = {
             "key": self.key.upper(),
             "_id": self._id,
@@ -252,7 +276,10 @@ class Task:
             task_data["args"] = self.args
 
         out = {k: v for k, v in task_data.items() if v is not None}
-        return json.dumps(out, indent=indent)
+        serialised = json.dumps(out, indent=indent)
+        if indent is None and not self.args:
+            self._json_cache = (fields, serialised)
+        return serialised
 
     @staticmethod
     def from_json(task_str):
@@ -1,6 +1,7 @@
 import dane.config
 from dane import Document, Task
 import unittest
+import json
 from yacs.config import CfgNode
 import os
 from tempfile import TemporaryDirectory
@@ -62,6 +63,26 @@ class TestTask(unittest.TestCase):
         self.assertEqual(self.task.key, new_task.key)
         self.assertEqual(self.task.priority, new_task.priority)
 
+    def test_serialize_after_update(self):
+        self.assertNotIn("state", json.loads(self.task.to_json()))
+
+        self.task.state = 201
+        self.task.key = "other"
+        serialised = json.loads(self.task.to_json())
+        self.assertEqual(serialised["state"], 201)
+        self.assertEqual(serialised["key"], "OTHER")
+
+        self.task.args["foo"] = "bar"
+        self.assertEqual(json.loads(str(self.task))["args"], {"foo": "bar"})
+
+        self.task.args.pop("foo")
+        self.assertNotIn("args", json.loads(self.task.to_json()))
+
+        task = Task("abc", foo="bar")
+        self.assertEqual(json.loads(task.to_json())["args"], {"foo": "bar"})
+        task.args.clear()
+        self.assertNotIn("args", json.loads(task.to_json()))
+
     def test_assign(self):
         self.task.set_api(self.dummy)
 
@@ -0,0 +1,325 @@
+import io
+import os
+import shutil
+import tarfile
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from boto3.exceptions import S3UploadFailedError
+from mockito import ANY, mock, unstub, verify, when
+from dane.s3_util import (
+    DEFAULT_MAX_CONCURRENCY,
+    S3Store,
+    _extract_member,
+    parse_s3_uri,
+    tar_list_of_files,
+    validate_s3_uri,
+)
+
+
+# Run this test file from the root dir: python -m test.test_s3_util
+class TestTarListOfFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.file_list = []
+        for i in range(3):
+            file_path = os.path.join(self.tmp_dir.name, f"file_{i}.txt")
+            with open(file_path, "w") as f:
+                f.write(f"contents of file {i}\n" * 100)
+            self.file_list.append(file_path)
+
+    def tearDown(self):
+        unstub()
+        self.tmp_dir.cleanup()
+
+    def assert_archive_contents(self, archive_path):
+        with tarfile.open(archive_path, "r:gz") as tar:
+            for file_path in self.file_list:
+                with open(file_path, "rb") as original:
+                    member = tar.extractfile(os.path.basename(file_path))
+                    self.assertEqual(original.read(), member.read())
+
+    def test_tar_list_of_files(self):
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        self.assertTrue(tar_list_of_files(archive_path, self.file_list))
+        self.assert_archive_contents(archive_path)
+
+    def test_tar_list_of_files_with_dir(self):
+        sub_dir = os.path.join(self.tmp_dir.name, "sub_dir")
+        os.makedirs(os.path.join(sub_dir, "nested"))
+        with open(os.path.join(sub_dir, "nested", "file.txt"), "w") as f:
+            f.write("nested file\n")
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        self.assertTrue(tar_list_of_files(archive_path, self.file_list + [sub_dir]))
+        with tarfile.open(archive_path, "r:gz") as tar:
+            self.assertEqual(
+                tar.getnames(),
+                [os.path.basename(f) for f in self.file_list]
+                + ["sub_dir", "sub_dir/nested", "sub_dir/nested/file.txt"],
+            )
+            member = tar.getmember("file_0.txt")
+            self.assertEqual(member.size, os.path.getsize(self.file_list[0]))
+            self.assertEqual(member.mode, os.stat(self.file_list[0]).st_mode & 0o7777)
+
+    def create_pigz_stub(self, script):
+        pigz_path = os.path.join(self.tmp_dir.name, "pigz")
+        with open(pigz_path, "w") as f:
+            f.write(f"#!/bin/sh\n{script}\n")
+        os.chmod(pigz_path, 0o755)
+        when(shutil).which("pigz").thenReturn(pigz_path)
+
+    @unittest.skipUnless(shutil.which("gzip"), "requires gzip as pigz stand-in")
+    def test_tar_list_of_files_with_pigz(self):
+        self.create_pigz_stub('exec gzip "$@"')
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        self.assertTrue(tar_list_of_files(archive_path, self.file_list))
+        self.assert_archive_contents(archive_path)
+
+    def test_tar_list_of_files_pigz_failure(self):
+        self.create_pigz_stub("exit 1")
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        with self.assertLogs("DANE", level="ERROR") as logs:
+            self.assertFalse(tar_list_of_files(archive_path, self.file_list))
+        self.assertIn("pigz exited with return code 1", "\n".join(logs.output))
+
+    def test_tar_list_of_files_without_pigz(self):
+        when(shutil).which("pigz").thenReturn(None)
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        self.assertTrue(tar_list_of_files(archive_path, self.file_list))
+        self.assert_archive_contents(archive_path)
+
+    def test_tar_list_of_files_invalid_path(self):
+        archive_path = os.path.join(self.tmp_dir.name, "archive.zip")
+        self.assertFalse(tar_list_of_files(archive_path, self.file_list))
+
+    def test_tar_list_of_files_missing_parent_dir(self):
+        archive_path = os.path.join(self.tmp_dir.name, "missing", "archive.tar.gz")
+        self.assertFalse(tar_list_of_files(archive_path, self.file_list))
+
+    def test_tar_list_of_files_missing_file(self):
+        archive_path = os.path.join(self.tmp_dir.name, "archive.tar.gz")
+        file_list = self.file_list + [os.path.join(self.tmp_dir.name, "missing")]
+        self.assertFalse(tar_list_of_files(archive_path, file_list))
+
+
+class TestParseS3Uri(unittest.TestCase):
+    def test_parse_s3_uri(self):
+        self.assertEqual(
+            parse_s3_uri("s3://beng-daan-visxp/jaap-dane-test/dane-test.tar.gz"),
+            ("beng-daan-visxp", "jaap-dane-test/dane-test.tar.gz"),
+        )
+        self.assertTrue(validate_s3_uri("s3://bucket/object"))
+
+    def test_parse_invalid_s3_uri(self):
+        for s3_uri in ["http://bucket/object", "s3://bucket", "s3://bucket/", "s3:///"]:
+            self.assertIsNone(parse_s3_uri(s3_uri))
+            self.assertFalse(validate_s3_uri(s3_uri))
+
+
+class TestS3Store(unittest.TestCase):
+    def setUp(self):
+        self.s3_store = S3Store()
+        self.s3_store.client = mock()
+
+    def tearDown(self):
+        unstub()
+
+    def test_connection_pool_size(self):
+        self.assertEqual(
+            S3Store().client.meta.config.max_pool_connections, DEFAULT_MAX_CONCURRENCY
+        )
+        self.assertEqual(
+            S3Store(max_concurrency=4).client.meta.config.max_pool_connections, 4
+        )
+
+    def test_transfer_to_s3(self):
+        file_list = [f"/data/file_{i}.txt" for i in range(10)]
+        when(self.s3_store.client).upload_file(
+            Filename=ANY, Bucket=ANY, Key=ANY, Config=ANY
+        ).thenReturn(None)
+        self.assertTrue(self.s3_store.transfer_to_s3("bucket", "path", file_list))
+        for f in file_list:
+            verify(self.s3_store.client, times=1).upload_file(
+                Filename=f,
+                Bucket="bucket",
+                Key=f"path/{os.path.basename(f)}",
+                Config=ANY,
+            )
+
+    def test_transfer_to_s3_concurrency(self):
+        configs = []
+        when(self.s3_store.client).upload_file(
+            Filename=ANY, Bucket=ANY, Key=ANY, Config=ANY
+        ).thenAnswer(lambda **kwargs: configs.append(kwargs["Config"]))
+        # a single file (e.g. the tar archive) gets all connections
+        self.assertTrue(self.s3_store.transfer_to_s3("bucket", "path", ["/data/f"]))
+        self.assertEqual(configs[0].max_concurrency, DEFAULT_MAX_CONCURRENCY)
+        # many files share them
+        file_list = [f"/data/file_{i}.txt" for i in range(4)]
+        self.assertTrue(self.s3_store.transfer_to_s3("bucket", "path", file_list))
+        self.assertEqual(configs[1].max_concurrency, DEFAULT_MAX_CONCURRENCY // 4)
+
+    def test_transfer_to_s3_key(self):
+        when(self.s3_store.client).upload_file(
+            Filename=ANY, Bucket=ANY, Key=ANY, Config=ANY
+        ).thenReturn(None)
+        for path, key in [("", "file.txt"), ("a/b/", "a/b/file.txt")]:
+            self.assertTrue(
+                self.s3_store.transfer_to_s3("bucket", path, ["/data/file.txt"])
+            )
+            verify(self.s3_store.client, times=1).upload_file(
+                Filename="/data/file.txt", Bucket="bucket", Key=key, Config=ANY
+            )
+
+    def test_transfer_to_s3_failure(self):
+        file_list = [f"/data/file_{i}.txt" for i in range(10)]
+        when(self.s3_store.client).upload_file(
+            Filename=ANY, Bucket=ANY, Key=ANY, Config=ANY
+        ).thenReturn(None)
+        when(self.s3_store.client).upload_file(
+            Filename="/data/file_3.txt", Bucket=ANY, Key=ANY, Config=ANY
+        ).thenRaise(S3UploadFailedError("upload failed"))
+        self.assertFalse(self.s3_store.transfer_to_s3("bucket", "path", file_list))
+        # the remaining uploads are still carried out
+        verify(self.s3_store.client, times=10).upload_file(
+            Filename=ANY, Bucket=ANY, Key=ANY, Config=ANY
+        )
+
+    def test_transfer_to_s3_streaming(self):
+        uploaded = io.BytesIO()
+        when(self.s3_store.client).upload_fileobj(
+            ANY, "bucket", "path/archive.tar.gz", Config=ANY
+        ).thenAnswer(lambda fileobj, *args, **kwargs: uploaded.write(fileobj.read()))
+        with TemporaryDirectory() as tmp_dir:
+            file_list = []
+            for i in range(3):
+                file_list.append(os.path.join(tmp_dir, f"file_{i}.txt"))
+                with open(file_list[-1], "w") as f:
+                    f.write(f"contents of file {i}\n")
+            self.assertTrue(
+                self.s3_store.transfer_to_s3_streaming(
+                    "bucket", "path/archive.tar.gz", file_list
+                )
+            )
+        uploaded.seek(0)
+        with tarfile.open(fileobj=uploaded, mode="r:gz") as tar:
+            self.assertEqual(tar.getnames(), ["file_0.txt", "file_1.txt", "file_2.txt"])
+            self.assertEqual(
+                tar.extractfile("file_1.txt").read(), b"contents of file 1\n"
+            )
+
+    def test_transfer_to_s3_streaming_large_file(self):
+        def read_in_parts(fileobj, *args, **kwargs):
+            # s3transfer reads non-seekable streams part by part like this
+            while chunk := fileobj.read(1024 * 1024):
+                uploaded.write(chunk)
+
+        uploaded = io.BytesIO()
+        when(self.s3_store.client).upload_fileobj(
+            ANY, "bucket", "path/archive.tar.gz", Config=ANY
+        ).thenAnswer(read_in_parts)
+        with TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "large.bin")
+            data = os.urandom(3 * 1024 * 1024)  # incompressible, spans many reads
+            with open(file_path, "wb") as f:
+                f.write(data)
+            self.assertTrue(
+                self.s3_store.transfer_to_s3_streaming(
+                    "bucket", "path/archive.tar.gz", [file_path]
+                )
+            )
+        uploaded.seek(0)
+        with tarfile.open(fileobj=uploaded, mode="r:gz") as tar:
+            self.assertEqual(tar.extractfile("large.bin").read(), data)
+
+    def test_transfer_to_s3_streaming_missing_file(self):
+        when(self.s3_store.client).upload_fileobj(
+            ANY, "bucket", "path/archive.tar.gz", Config=ANY
+        ).thenAnswer(lambda fileobj, *args, **kwargs: fileobj.read())
+        with self.assertLogs("DANE", level="WARNING") as logs:
+            self.assertFalse(
+                self.s3_store.transfer_to_s3_streaming(
+                    "bucket", "path/archive.tar.gz", ["/non/existing/file"]
+                )
+            )
+        output = "\n".join(logs.output)
+        self.assertIn("ERROR:DANE:Failed to write archive", output)
+        self.assertIn("FileNotFoundError", output)
+        self.assertNotIn("Upload stopped", output)
+
+    def test_download_file(self):
+        with TemporaryDirectory() as tmp_dir:
+            output_folder = os.path.join(tmp_dir, "output")
+            when(self.s3_store.client).download_file(
+                "bucket", "path/archive.tar.gz", ANY, Config=ANY
+            ).thenReturn(None)
+            self.assertTrue(
+                self.s3_store.download_file(
+                    "bucket", "path/archive.tar.gz", output_folder
+                )
+            )
+            self.assertTrue(os.path.isdir(output_folder))
+            verify(self.s3_store.client, times=1).download_file(
+                "bucket",
+                "path/archive.tar.gz",
+                os.path.join(output_folder, "archive.tar.gz"),
+                Config=self.s3_store.transfer_config,
+            )
+
+    def test_download_and_extract(self):
+        with TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file.txt")
+            with open(file_path, "w") as f:
+                f.write("contents of file\n")
+            archive_path = os.path.join(tmp_dir, "archive.tar.gz")
+            self.assertTrue(tar_list_of_files(archive_path, [file_path]))
+            with open(archive_path, "rb") as f:
+                body = io.BytesIO(f.read())
+            when(self.s3_store.client).get_object(
+                Bucket="bucket", Key="path/archive.tar.gz"
+            ).thenReturn({"Body": body})
+
+            output_folder = os.path.join(tmp_dir, "output")
+            self.assertTrue(
+                self.s3_store.download_file(
+                    "bucket", "path/archive.tar.gz", output_folder, extract=True
+                )
+            )
+            self.assertEqual(os.listdir(output_folder), ["file.txt"])
+            with open(os.path.join(output_folder, "file.txt")) as f:
+                self.assertEqual(f.read(), "contents of file\n")
+
+    def test_extract_member_without_data_filter(self):
+        with TemporaryDirectory() as tmp_dir:
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+                for name, data in [("file.txt", b"contents"), ("../evil.txt", b"")]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            archive.seek(0)
+            output_folder = os.path.join(tmp_dir, "output")
+            # as on Python < 3.10.12/3.11.4
+            with patch("dane.s3_util.HAS_TAR_DATA_FILTER", False):
+                with tarfile.open(fileobj=archive, mode="r|gz") as tar:
+                    members = iter(tar)
+                    _extract_member(tar, next(members), output_folder)
+                    with self.assertRaises(tarfile.TarError):
+                        _extract_member(tar, next(members), output_folder)
+            self.assertEqual(os.listdir(tmp_dir), ["output"])
+            self.assertEqual(os.listdir(output_folder), ["file.txt"])
+
+    def test_download_and_extract_invalid_archive(self):
+        when(self.s3_store.client).get_object(
+            Bucket="bucket", Key="path/archive.tar.gz"
+        ).thenReturn({"Body": io.BytesIO(b"not a tar.gz")})
+        with TemporaryDirectory() as tmp_dir:
+            self.assertFalse(
+                self.s3_store.download_and_extract(
+                    "bucket", "path/archive.tar.gz", tmp_dir
+                )
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()